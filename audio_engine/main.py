@@ -1,11 +1,16 @@
 import os
 import threading
 import time
+from collections import deque
+from functools import lru_cache
+from itertools import count
 import numpy as np
 import soundfile as sf
 import sounddevice as sd
-from scipy.signal import tf2sos, sosfilt # resample is now handled by Rust
-from flask import Flask, request, jsonify
+from scipy.signal import sosfilt # resample is now handled by Rust
+from scipy import fft as sfft
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
 import logging
@@ -13,13 +18,166 @@ import argparse
 import hashlib
 import subprocess
 import io
+import orjson
 import rust_audio_resampler # <-- 导入我们新的 Rust 模块
 
+try:
+    from numba import njit
+except ImportError: # numba 为可选依赖，缺失时EQ退回到 scipy 的 sosfilt
+    njit = None
+
+_cupy_error = None
+try:
+    # CuPy 为可选依赖：声道数 x 滤波节数很大时 (多声道/环绕声)，EQ 可卸载到 GPU
+    import cupy as cp
+    from cupyx.scipy.signal import sosfilt as cp_sosfilt
+    # 装了 CuPy 但没有可用的 CUDA 设备/驱动时，后续 cp.asarray 会失败：启动时检查一次
+    if cp.cuda.runtime.getDeviceCount() < 1:
+        cp = None
+except ImportError:
+    cp = None
+except Exception as e: # CUDA 运行时错误，在日志配置完成后再记录
+    _cupy_error = e
+    cp = None
+
+try:
+    import xxhash # 可选依赖：比标准库哈希更快，用于计算缓存键
+except ImportError:
+    xxhash = None
+
+try:
+    # pyFFTW 为可选依赖：缓存FFT计划，避免每次调用重新规划
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft
+    pyfftw.interfaces.cache.enable()
+    sfft.set_global_backend(pyfftw.interfaces.scipy_fft)
+except ImportError:
+    pass
+
+try:
+    import msgpack # 可选依赖：Socket.IO 数据包改用 MessagePack 编码
+except ImportError:
+    msgpack = None
+
+# --- JSON 序列化 ---
+class OrjsonProvider(JSONProvider):
+    """基于 orjson 的 JSON provider：jsonify 与 request.get_json 都走 orjson 的 C 实现。"""
+    _options = orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self._options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        # 直接返回 orjson 生成的 bytes，跳过 str 编解码
+        return self._app.response_class(orjson.dumps(obj, option=self._options), mimetype='application/json')
+
 # --- 全局配置 ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+if _cupy_error is not None:
+    logging.warning(f"CuPy is installed but no usable CUDA device was found; GPU EQ disabled: {_cupy_error}")
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)  # 允许跨域请求
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='gevent')
+# SocketIO 先不绑定 app：线格式相关的选项来自命令行参数，在 __main__ 中解析后由 init_socketio 绑定
+socketio = SocketIO()
+
+def init_socketio(use_msgpack=False, websocket_only=False):
+    """
+    将 socketio 绑定到 app。
+    use_msgpack: 数据包改用 MessagePack 编码 (--socketio-msgpack)，前端需同时启用 socket.io-msgpack-parser。
+    websocket_only: 跳过长轮询握手 (--websocket-only)，前端需以 io({transports: ['websocket'], upgrade: false}) 连接。
+    """
+    transports = ['websocket'] if websocket_only else ['polling', 'websocket']
+    # 使用原生线程而非 gevent：gevent 的猴子补丁与 PortAudio 的实时回调线程相互干扰
+    # 数据包同样通过 orjson 编码 (后台任务中没有应用上下文时 flask.json 会退回标准库)
+    socketio.init_app(app, cors_allowed_origins="*", async_mode='threading', json=app.json,
+                      serializer='msgpack' if use_msgpack else 'default', logger=False, engineio_logger=False,
+                      transports=transports, allow_upgrades=not websocket_only)
+
+# --- EQ 滤波内核 ---
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def _biquad_cascade(x, sos, zi):
+        """
+        原地对 x (frames, channels) 执行级联双二阶滤波 (直接II型转置)。
+        sos 形状为 (n_sections, 6)，zi 形状为 (n_sections, channels, 2)。
+        """
+        frames, channels = x.shape
+        n_sections = sos.shape[0]
+        for n in range(frames):
+            for s in range(n_sections):
+                b0 = sos[s, 0]
+                b1 = sos[s, 1]
+                b2 = sos[s, 2]
+                a1 = sos[s, 4]
+                a2 = sos[s, 5]
+                for c in range(channels):
+                    xn = x[n, c]
+                    y = b0 * xn + zi[s, c, 0]
+                    zi[s, c, 0] = b1 * xn - a1 * y + zi[s, c, 1]
+                    zi[s, c, 1] = b2 * xn - a2 * y
+                    x[n, c] = y
+else:
+    _biquad_cascade = None
+
+def _sosfilt_columns(sosfilt_fn, sos, x, zi_t):
+    """
+    沿 axis=0 对 (frames, channels) 的 x 做级联滤波并返回结果，供 GPU 路径使用。
+    zi_t 必须是 sosfilt(axis=0) 要求的 (n_sections, 2, channels) 布局 (与 CPU 路径的
+    (n_sections, channels, 2) 不同)，原地更新。sosfilt_fn 可以是 cupyx 或 scipy 的实现。
+    """
+    if zi_t.shape != (sos.shape[0], 2, x.shape[1]):
+        raise ValueError(f"zi must be (n_sections, 2, channels), got {zi_t.shape}")
+    y, zi_t[...] = sosfilt_fn(sos, x, axis=0, zi=zi_t)
+    return y
+
+# --- EQ 频段配置 (按中心频率升序排列，即级联顺序) ---
+_EQ_BAND_NAMES = ('31', '62', '125', '250', '500', '1k', '2k', '4k', '8k', '16k')
+_EQ_CENTER_FREQS = np.array([31, 62, 125, 250, 500, 1000, 2000, 4000, 8000, 16000], dtype=np.float64)
+_EQ_Q = 1.41
+
+_CACHE_DIGEST_BYTES = 64 * 1024
+
+def _file_digest(file_path, size):
+    """对文件开头和结尾各 64 KiB 的内容计算摘要，作为重采样缓存键的内容指纹。"""
+    h = xxhash.xxh3_64() if xxhash is not None else hashlib.blake2b(digest_size=8)
+    with open(file_path, 'rb') as f:
+        h.update(f.read(_CACHE_DIGEST_BYTES))
+        if size > _CACHE_DIGEST_BYTES:
+            f.seek(max(_CACHE_DIGEST_BYTES, size - _CACHE_DIGEST_BYTES))
+            h.update(f.read(_CACHE_DIGEST_BYTES))
+    return h.hexdigest()
+
+@lru_cache(maxsize=8)
+def _get_hann(n, dtype=np.float32):
+    """返回长度为 n 的只读汉宁窗，按 (n, dtype) 缓存，FFT 尺寸变化时无需重新计算。"""
+    window = np.hanning(n).astype(dtype)
+    window.flags.writeable = False
+    return window
+
+def _pin_current_thread(cpu):
+    """将调用线程绑定到指定 CPU 核心；仅 Linux 提供 sched_setaffinity，其他平台直接跳过。"""
+    if cpu is None or not hasattr(os, 'sched_setaffinity'):
+        return
+    try:
+        os.sched_setaffinity(0, {cpu})
+    except OSError as e:
+        logging.warning(f"Could not pin thread to CPU {cpu}: {e}")
+
+class _StateField:
+    """对外状态字段：赋值时同步写入 AudioEngine._state，get_state 无需加锁重建字典。
+    只定义 __set__，读取时直接命中实例字典，不增加热路径上的属性访问开销。"""
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+        obj._state[self.name] = value
 
 # --- 音频引擎核心类 ---
 class AudioEngine:
@@ -27,7 +185,25 @@ class AudioEngine:
     管理音频播放、解码、FFT计算和状态的核心类。
     在一个独立的线程中运行以避免阻塞Flask服务器。
     """
+    is_playing = _StateField()
+    is_paused = _StateField()
+    file_path = _StateField()
+    volume = _StateField()
+    device_id = _StateField()
+    exclusive_mode = _StateField()
+
     def __init__(self, socketio_instance):
+        # 由状态字段在赋值时推送更新 (current_time 在 get_state 中按当前位置计算)
+        self._state = {
+            'is_playing': False,
+            'is_paused': False,
+            'duration': 0,
+            'current_time': 0,
+            'file_path': None,
+            'volume': 1.0,
+            'device_id': None,
+            'exclusive_mode': False
+        }
         self.socketio = socketio_instance
         self.stream = None
         self.file_path = None
@@ -39,12 +215,18 @@ class AudioEngine:
         self.is_paused = False
         self.lock = threading.RLock() # 使用可重入锁解决死锁问题
         self.thread = None
+        self.emitter_thread = None
         self.stop_event = threading.Event()
         self.volume = 1.0  # 音量，范围 0.0 到 1.0
         self.fft_size = 2048  # FFT窗口大小, for better low-freq resolution
-        self.hanning_window = np.hanning(self.fft_size) # 性能优化：预计算汉宁窗
+        self.hanning_window = _get_hann(self.fft_size) # 性能优化：预计算汉宁窗
+        self._fft_scratch = np.zeros(self.fft_size, dtype=np.float32) # FFT输入缓冲区，避免每帧分配
+        self._fft_magnitude = np.empty(self.fft_size // 2 + 1, dtype=np.float32) # FFT幅度谱缓冲区
+        self._inv_fft_size = 1.0 / self.fft_size
         self.fft_update_interval = 1.0 / 20.0  # B3: 更新频率降至20Hz，降低前端负载
         self.num_log_bins = 48 # Number of bars for the visualizer
+        self._log_binned_magnitude = np.zeros(self.num_log_bins) # 可视化频段幅度缓冲区
+        self._spectrum_bytes = np.zeros(self.num_log_bins, dtype=np.uint8) # 量化后的频谱帧
         self.device_id = None # Can be None for default device
         self.exclusive_mode = False
         self.target_samplerate = None  # None代表不进行升频
@@ -55,146 +237,297 @@ class AudioEngine:
            '1k': 0, '2k': 0, '4k': 0, '8k': 0, '16k': 0
         }
         self.eq_filters = {} # To store SOS filter coefficients
-        self.eq_zi = {} # To store initial filter conditions for each channel
+        self._active_bands = [] # 增益非零且低于奈奎斯特频率的频段
+        self._cascaded_sos = None # 所有激活频段级联后的SOS矩阵, shape (n_sections, 6)
+        self._cascaded_zi = None # 连续的滤波器状态, shape (n_sections, n_channels, 2)
+        self._gpu_eq = None # (sos, zi) 的 CuPy 副本，仅在启用 GPU EQ 时存在
+        self.gpu_eq_threshold = 64 # 声道数 x 滤波节数 达到该值时使用 GPU 处理EQ
         self.resample_cache_dir = None
+        # 为 True 时频谱以 uint8 二进制帧发送 (--binary-spectrum，前端用 Uint8Array 解码后除以255)，
+        # 否则保持 {'data': [0-1 浮点数]} 的 JSON 格式
+        self.binary_spectrum = False
+        # --- Look-ahead rendering (see _render_ahead) ---
+        self.render_thread = None
+        self._render_lock = threading.Lock() # 串行化渲染线程与控制线程的预渲染
+        self._render_block = 8192 # 每次EQ处理的帧数
+        self._ring = None # 预渲染环形缓冲区，源位置 p 的帧存放在 ring[p % capacity]
+        self._ring_state = (0, 0) # (base, head): 环形缓冲区中有效的源帧区间 [base, head)
+        self._render_scratch = None # 渲染线程使用的预分配缓冲区, shape (render_block, channels)
+        # --- Spectrum binning (see _update_spectrum_bins) ---
+        self._bin_lo = 0
+        self._bin_hi = 0
+        self._bin_starts = None
+        self._bin_counts = None
+        self._bin_rms = None
+        self._bin_targets = None
+        # --- Realtime snapshot (see _publish_active_state) ---
+        self._active_state = (None, None, self.volume)
+        self._seek_request = None
+        self._applied_seek_request = None
+        # 只保留最新一帧频谱：网络发送跟不上时直接丢弃旧帧
+        self._spectrum_queue = deque(maxlen=1)
+        self._spectrum_ready = threading.Event() # 入队后置位，发送线程阻塞等待而非轮询
+        # 渲染线程与 PortAudio 回调线程绑定的核心 (None 表示不绑定)，见 __main__
+        self.dsp_cpu = None
+        self._pinned_callback_thread = None
 
     def _stream_callback(self, outdata, frames, time, status):
         """sounddevice的回调函数，用于填充音频数据"""
         if status:
             logging.warning(f"Stream callback status: {status}")
 
-        with self.lock:
-            if self.data is None or self.position + frames > len(self.data):
-                outdata.fill(0)
-                self.is_playing = False
-                return
+        # PortAudio 的回调线程由驱动创建，只能在首次进入回调时绑定核心
+        if self.dsp_cpu is not None and self._pinned_callback_thread != threading.get_ident():
+            self._pinned_callback_thread = threading.get_ident()
+            _pin_current_thread(self.dsp_cpu)
+
+        # 实时线程中不加锁：控制线程通过原子的属性/元组赋值发布状态，这里只读取一次快照
+        data = self.data
+        volume = self._active_state[2]
+        position = self.position
+        seek_request = self._seek_request
+        if seek_request is not self._applied_seek_request:
+            self._applied_seek_request = seek_request
+            position = seek_request[0]
+
+        if data is None or position + frames > len(data):
+            outdata.fill(0)
+            self.is_playing = False
+            return
 
-            chunk = self.data[self.position : self.position + frames].copy() # Use a copy to modify
-                
-            # --- Apply EQ if enabled ---
-            if self.eq_enabled and self.eq_filters:
-                # 性能优化 (B2): 将所有启用的SOS滤波器级联后一次性处理
-                active_sos_list = [self.eq_filters[band] for band in self.eq_filters if self.eq_bands.get(band, 0) != 0]
-                if active_sos_list:
-                    cascaded_sos = np.vstack(active_sos_list)
-                    
-                    for i in range(self.channels):
-                        if i not in self.eq_zi:
-                            self._initialize_eq_zi(i)
-                        
-                        channel_data = chunk[:, i] if self.channels > 1 else chunk
-                        
-                        # 从 self.eq_zi 中提取对应激活的滤波器的 zi
-                        active_zi = np.vstack([self.eq_zi[i][band] for band in self.eq_filters if self.eq_bands.get(band, 0) != 0])
-                        
-                        channel_data, updated_zi = sosfilt(cascaded_sos, channel_data, zi=active_zi)
-                        
-                        # 将更新后的 zi 写回 self.eq_zi
-                        zi_counter = 0
-                        for band in self.eq_filters:
-                            if self.eq_bands.get(band, 0) != 0:
-                                num_sections = self.eq_filters[band].shape[0]
-                                self.eq_zi[i][band] = updated_zi[zi_counter : zi_counter + num_sections, :]
-                                zi_counter += num_sections
-
-                        if self.channels > 1:
-                            chunk[:, i] = channel_data
-                        else:
-                            chunk = channel_data
-
-            # 应用音量并进行限幅
-            mixed = chunk * self.volume
-            np.clip(mixed, -1.0, 1.0, out=mixed)
-            outdata[:] = mixed
-            self.position += frames
+        # 性能优化: EQ 已由渲染线程批量完成，回调只需从环形缓冲区拷贝并应用音量
+        ring = self._ring
+        base, head = self._ring_state
+        if ring is None or position < base or position + frames > head:
+            # 预渲染数据尚未就绪：输出静音并停在原位，待渲染线程追上后继续
+            outdata.fill(0)
+            self.position = position
+            return
+
+        capacity = len(ring)
+        start = position % capacity
+        first = min(frames, capacity - start)
+        # 应用音量并进行限幅，直接写入输出缓冲区
+        np.multiply(ring[start:start + first], volume, out=outdata[:first])
+        if first < frames:
+            np.multiply(ring[:frames - first], volume, out=outdata[first:])
+        np.clip(outdata, -1.0, 1.0, out=outdata)
+        self.position = position + frames
+
+    def _render_ahead(self, position=None):
+        """
+        将播放位置之后的音频按 8192 帧的大块执行EQ并写入环形缓冲区。
+        由渲染线程周期性调用，控制线程在开始播放、跳转和EQ变化时也会同步调用一次。
+        """
+        with self._render_lock:
+            ring, scratch, data = self._ring, self._render_scratch, self.data
+            if ring is None or data is None:
+                return
+            if position is None:
+                seek_request = self._seek_request
+                position = seek_request[0] if seek_request is not self._applied_seek_request else self.position
+            capacity = len(ring)
+            base, head = self._ring_state
+            if not base <= position <= head:
+                # 播放位置已离开预渲染区间 (例如跳转)：从当前位置重新开始
+                base = head = position
+                self._ring_state = (base, head)
+
+            # 至少留出一个渲染块，确保不会覆盖回调正在读取的数据
+            limit = min(len(data), position + capacity - self._render_block)
+            while head < limit:
+                frames = min(self._render_block, limit - head)
+                block = scratch[:frames]
+                np.copyto(block, data[head:head + frames])
+                sos, zi, volume = self._active_state
+                if sos is not None:
+                    try:
+                        self._apply_eq(block, sos, zi)
+                    except Exception:
+                        # EQ 出错时不能让渲染中断 (回调会一直输出静音)：本块退回未滤波的数据，
+                        # 并旁路EQ直到下一次EQ/音量变化重新发布快照
+                        logging.error("EQ processing failed; bypassing EQ", exc_info=True)
+                        np.copyto(block, data[head:head + frames])
+                        self._active_state = (None, None, volume)
+
+                start = head % capacity
+                first = min(frames, capacity - start)
+                ring[start:start + first] = block[:first]
+                ring[:frames - first] = block[first:]
+                head += frames
+                self._ring_state = (max(base, head - capacity), head)
+
+    def _invalidate_lookahead(self):
+        """EQ变化后丢弃尚未播放的预渲染数据 (保留回调可能正在读取的部分)，并用新滤波器重新渲染。"""
+        if not self.is_playing:
+            return
+        with self._render_lock:
+            base, head = self._ring_state
+            keep = self.position + self._render_block // 2
+            if head > keep:
+                self._ring_state = (base, max(base, keep))
+        self._render_ahead()
+
+    def _render_thread(self):
+        """在独立线程中预渲染音频，每半个渲染块的时长补充一次环形缓冲区"""
+        interval = self._render_block / 2 / self.samplerate
+        _pin_current_thread(self.dsp_cpu)
+        while not self.stop_event.wait(interval):
+            if self.is_playing and not self.is_paused:
+                try:
+                    self._render_ahead()
+                except Exception:
+                    # 渲染失败时停止播放并通知前端，而不是让回调无限期地输出静音
+                    logging.error("Render thread failed; stopping playback", exc_info=True)
+                    self._ring_state = (0, 0)
+                    self.is_playing = False
+                    self.socketio.emit('playback_state', self.get_state())
+
+    def _apply_eq(self, block, sos, zi):
+        """对 (frames, channels) 的数据块原地应用级联EQ滤波器。"""
+        if cp is not None and isinstance(sos, cp.ndarray):
+            # GPU 路径：zi 为 (n_sections, 2, channels) 布局，见 _initialize_eq_zi
+            filtered = _sosfilt_columns(cp_sosfilt, sos, cp.asarray(block), zi)
+            # sos 为 float64 时结果也是 float64，拷回主机后再写入 float32 的 block
+            block[...] = cp.asnumpy(filtered)
+        elif _biquad_cascade is not None:
+            # 性能优化: 编译后的内核一次遍历所有声道和所有滤波节
+            _biquad_cascade(block, sos, zi)
+        else:
+            for i in range(block.shape[1]):
+                block[:, i], zi[:, i] = sosfilt(sos, block[:, i], zi=zi[:, i])
 
     def _playback_thread(self):
         """在独立线程中运行播放和FFT计算"""
-        last_fft_time = 0
+        # 按截止时间调度：每个周期只唤醒一次，保持精确的更新频率
+        next_tick = time.monotonic()
         while not self.stop_event.is_set():
-            if self.is_playing and not self.is_paused:
-                current_time = time.time()
-                # --- FFT 计算和发送 ---
-                if current_time - last_fft_time >= self.fft_update_interval:
-                    last_fft_time = current_time
-                    with self.lock:
-                        if self.data is None:
-                            continue
-                        # 获取当前播放位置附近的数据块用于FFT
-                        start = self.position
-                        end = start + self.fft_size
-                        if end > len(self.data):
-                            # 如果接近末尾，补零
-                            pad_width = end - len(self.data)
-                            if self.channels > 1:
-                                fft_chunk = np.pad(self.data[start:], ((0, pad_width), (0, 0)), 'constant')
-                            else:
-                                fft_chunk = np.pad(self.data[start:], (0, pad_width), 'constant')
-                        else:
-                            fft_chunk = self.data[start:end]
-                        
-                        # 如果是多声道，转为单声道
-                        if self.channels > 1:
-                            fft_chunk = fft_chunk.mean(axis=1)
-
-                        # 应用汉宁窗以减少频谱泄漏
-                        # 性能优化 (B1): 使用预计算的汉宁窗
-                        fft_chunk = fft_chunk * self.hanning_window
-                        
-                        # 执行FFT
-                        fft_result = np.fft.rfft(fft_chunk)
-                        magnitude = np.abs(fft_result)
-                        
-                        # CRITICAL FIX: Normalize the FFT magnitude by the window size.
-                        # This is the root cause of all previous "clipping" and "flat" issues.
-                        # Without this, the magnitude scale is arbitrary and far too large.
-                        magnitude = magnitude / self.fft_size
-
-                        # --- New Logarithmic Binning ---
-                        freqs = np.fft.rfftfreq(self.fft_size, 1.0 / self.samplerate)
-
-                        # Ignore DC component (first bin) and Nyquist
-                        freqs = freqs[1:-1]
-                        magnitude = magnitude[1:-1]
-
-                        log_binned_magnitude = np.zeros(self.num_log_bins)
-                        if len(freqs) > 0:
-                            # Define logarithmic bin edges
-                            min_freq = 20
-                            max_freq = self.samplerate / 2
-                            if max_freq > min_freq:
-                                log_min = np.log10(min_freq)
-                                log_max = np.log10(max_freq)
-                                
-                                log_bin_edges = np.logspace(log_min, log_max, self.num_log_bins + 1)
-                                
-                                # Assign each FFT frequency to a log bin using digitize
-                                bin_indices = np.digitize(freqs, log_bin_edges)
-                                
-                                for i in range(1, self.num_log_bins + 1):
-                                    in_bin_mask = (bin_indices == i)
-                                    if np.any(in_bin_mask):
-                                        # Use Root Mean Square (RMS) for a perceptually accurate representation of power.
-                                        log_binned_magnitude[i-1] = np.sqrt(np.mean(np.square(magnitude[in_bin_mask])))
-
-                        # 转换为分贝并归一化
-                        log_magnitude = 20 * np.log10(log_binned_magnitude + 1e-9) # 避免log(0)
-                        
-                        # With the FFT properly normalized, we can use a standard 90dB dynamic range.
-                        # This provides a good balance of sensitivity and headroom.
-                        normalized_magnitude = np.clip((log_magnitude + 90) / 90, 0, 1)
+            next_tick += self.fft_update_interval
+            delay = next_tick - time.monotonic()
+            if delay < 0:
+                # 落后超过一个周期时重新对齐，避免连续补帧
+                next_tick = time.monotonic()
+                delay = 0
+            if self.stop_event.wait(delay):
+                break
+            if not self.is_playing or self.is_paused:
+                continue
 
-                    # 通过WebSocket发送频谱数据
-                    self.socketio.emit('spectrum_data', {'data': normalized_magnitude.tolist()})
+            # --- FFT 计算和发送 ---
+            with self.lock:
+                if self.data is None:
+                    continue
+                # 获取当前播放位置附近的数据块用于FFT
+                # 性能优化: 写入预分配的scratch缓冲区，接近末尾时剩余部分补零，
+                # 多声道转单声道直接融合在拷贝中完成
+                start = self.position
+                avail = max(0, min(self.fft_size, len(self.data) - start))
+                fft_chunk = self._fft_scratch
+                np.mean(self.data[start:start + avail], axis=1, dtype=np.float32, out=fft_chunk[:avail])
+                fft_chunk[avail:] = 0
+
+                # 应用汉宁窗以减少频谱泄漏
+                # 性能优化 (B1): 使用预计算的汉宁窗，原地相乘
+                np.multiply(fft_chunk, self.hanning_window, out=fft_chunk)
+                
+                # 执行FFT (fft_chunk 是每帧都会重写的scratch缓冲区，允许覆盖)
+                fft_result = sfft.rfft(fft_chunk, n=self.fft_size, overwrite_x=True, workers=1)
+                magnitude = self._fft_magnitude
+                np.abs(fft_result, out=magnitude)
+                
+                # CRITICAL FIX: Normalize the FFT magnitude by the window size.
+                # This is the root cause of all previous "clipping" and "flat" issues.
+                # Without this, the magnitude scale is arbitrary and far too large.
+                magnitude *= self._inv_fft_size
+
+                # --- New Logarithmic Binning ---
+                # 性能优化: 频段划分已在 load() 中预计算，这里一次 reduceat 完成分组，全部写入预分配缓冲区
+                log_binned_magnitude = self._log_binned_magnitude
+                log_binned_magnitude.fill(0)
+                if self._bin_targets is not None:
+                    power = magnitude[self._bin_lo:self._bin_hi]
+                    np.square(power, out=power)
+                    # Use Root Mean Square (RMS) for a perceptually accurate representation of power.
+                    binned = self._bin_rms
+                    np.add.reduceat(power, self._bin_starts, out=binned)
+                    binned /= self._bin_counts
+                    np.sqrt(binned, out=binned)
+                    log_binned_magnitude[self._bin_targets] = binned
+
+                # 转换为分贝并归一化: (20 * log10(m + 1e-9) + 90) / 90
+                # 性能优化: 全部原地计算，不产生中间数组
+                # With the FFT properly normalized, we can use a standard 90dB dynamic range.
+                # This provides a good balance of sensitivity and headroom.
+                normalized_magnitude = log_binned_magnitude
+                normalized_magnitude += 1e-9 # 避免log(0)
+                np.log10(normalized_magnitude, out=normalized_magnitude)
+                normalized_magnitude *= 20.0 / 90.0
+                normalized_magnitude += 1.0
+                np.clip(normalized_magnitude, 0, 1, out=normalized_magnitude)
+
+                # 量化为 uint8 (0-255)，每个频段一个字节
+                normalized_magnitude *= 255.0
+                np.rint(normalized_magnitude, out=normalized_magnitude)
+                np.copyto(self._spectrum_bytes, normalized_magnitude, casting='unsafe')
+                spectrum_payload = self._spectrum_bytes.tobytes()
+
+            # 交给发送线程，由它按 binary_spectrum 选择发送格式
+            self._spectrum_queue.append(spectrum_payload)
+            self._spectrum_ready.set()
+
+            # --- 检查播放是否结束 ---
+            with self.lock:
+                if self.data is None or self.position >= len(self.data):
+                    self.is_playing = False
+                    self.socketio.emit('playback_state', self.get_state())
+
+    def _spectrum_emitter_thread(self):
+        """在独立线程中发送最新的频谱帧，使网络I/O延迟不影响播放线程"""
+        while True:
+            self._spectrum_ready.wait()
+            if self.stop_event.is_set():
+                break
+            # 先清除再取出：取出之后到达的帧会重新置位，不会丢失唤醒
+            self._spectrum_ready.clear()
+            try:
+                payload = self._spectrum_queue.popleft()
+            except IndexError:
+                continue
+            if self.binary_spectrum:
+                self.socketio.emit('spectrum_data', payload)
+            else:
+                self.socketio.emit('spectrum_data', {'data': (np.frombuffer(payload, dtype=np.uint8) / 255.0).tolist()})
+
+    def _update_spectrum_bins(self):
+        """根据当前采样率预计算可视化所用的对数频段划分。"""
+        self._bin_targets = None
+        min_freq = 20
+        max_freq = self.samplerate / 2
+        if max_freq <= min_freq:
+            return
 
-                # --- 检查播放是否结束 ---
-                with self.lock:
-                    if self.data is None or self.position >= len(self.data):
-                        self.is_playing = False
-                        self.socketio.emit('playback_state', self.get_state())
+        # Ignore DC component (first bin) and Nyquist
+        freqs = sfft.rfftfreq(self.fft_size, 1.0 / self.samplerate)[1:-1]
+        log_bin_edges = np.logspace(np.log10(min_freq), np.log10(max_freq), self.num_log_bins + 1)
 
-            # 短暂休眠以降低CPU使用率
-            time.sleep(0.01)
+        # Assign each FFT frequency to a log bin using digitize.
+        # freqs 单调递增，因此每个频段对应频谱中一段连续的区间。
+        bin_indices = np.digitize(freqs, log_bin_edges)
+        in_range = np.nonzero((bin_indices >= 1) & (bin_indices <= self.num_log_bins))[0]
+        if len(in_range) == 0:
+            return
+        lo, hi = in_range[0], in_range[-1] + 1
+        counts = np.bincount(bin_indices[lo:hi] - 1, minlength=self.num_log_bins)
+
+        # 空频段保持为0，只对非空频段做 reduceat
+        targets = np.nonzero(counts)[0]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        self._bin_lo = lo + 1 # +1 补偿被跳过的DC分量
+        self._bin_hi = hi + 1
+        self._bin_starts = starts[targets]
+        self._bin_counts = counts[targets].astype(np.float64)
+        self._bin_rms = np.empty(len(targets), dtype=np.float32)
+        self._bin_targets = targets
 
     def load(self, file_path):
         """加载音频文件，应用缓存，并为播放做准备。"""
@@ -205,7 +538,7 @@ class AudioEngine:
                 # --- 1. Load Audio Data (with FFmpeg fallback) ---
                 try:
                     logging.info(f"Attempting to load {file_path} with soundfile...")
-                    original_data, original_samplerate = sf.read(file_path, dtype='float64')
+                    original_data, original_samplerate = sf.read(file_path, dtype='float32')
                     logging.info("Successfully loaded with soundfile.")
                 except sf.LibsndfileError as e:
                     if 'Format not recognised' in str(e):
@@ -231,7 +564,7 @@ class AudioEngine:
                             raise sf.LibsndfileError(f"FFmpeg decoding failed for {file_path}")
 
                         try:
-                            original_data, original_samplerate = sf.read(io.BytesIO(stdout_data), dtype='float64')
+                            original_data, original_samplerate = sf.read(io.BytesIO(stdout_data), dtype='float32')
                             logging.info(f"Successfully loaded {file_path} via FFmpeg.")
                         except Exception as read_e:
                             logging.error(f"Failed to read from FFmpeg stdout stream: {read_e}", exc_info=True)
@@ -241,7 +574,10 @@ class AudioEngine:
 
                 # --- 2. Correctly Determine Channels ---
                 # 修复：在读取数据后立即确定通道数
-                channels = original_data.shape[1] if original_data.ndim > 1 else 1
+                # 单声道统一存储为 (N, 1)，使回调、EQ和FFT路径无需区分声道数
+                if original_data.ndim == 1:
+                    original_data = original_data[:, None]
+                channels = original_data.shape[1]
 
                 # --- 3. Determine Target Samplerate ---
                 target_sr = original_samplerate
@@ -259,19 +595,26 @@ class AudioEngine:
 
                 # --- 4. Robust Caching Logic ---
                 # 修复：使用更健壮的缓存键
+                # 在修改时间 + 大小之外再加上首尾内容指纹：修改时间不可靠时也能发现内容变化，
+                # 而只改动中间内容 (大小不变) 的文件仍会因修改时间变化而失效。任一信号变化都只是多一次重采样
                 st = os.stat(file_path)
-                key = f"{file_path}|{st.st_mtime_ns}|{st.st_size}|sr={target_sr}|fmt=f32le|ch={channels}"
-                cache_filename = hashlib.md5(key.encode()).hexdigest() + '.wav'
+                key = f"{_file_digest(file_path, st.st_size)}|{st.st_mtime_ns}|{st.st_size}|sr={target_sr}|ch={channels}"
+                cache_filename = key.replace('|', '_') + '.npy'
                 cache_filepath = os.path.join(self.resample_cache_dir, cache_filename) if self.resample_cache_dir else None
 
                 if cache_filepath and os.path.exists(cache_filepath):
                     logging.info(f"Loading resampled data from cache: {cache_filepath}")
-                    self.data, self.samplerate = sf.read(cache_filepath, dtype='float64')
+                    # 缓存为原始 float32 的 .npy 文件，以内存映射方式打开：无需解码，由操作系统按需分页读入
+                    self.data = np.load(cache_filepath, mmap_mode='r')
+                    self.samplerate = target_sr
                 else:
                     # --- 5. Perform Resampling if needed (with correct channel count) ---
                     if target_sr != original_samplerate:
                         logging.info(f"Resampling from {original_samplerate} Hz to {target_sr} Hz...")
-                        flat_data = original_data.flatten()
+                        # Rust 重采样器只接受 C 连续的 float64 一维数组：
+                        # 类型转换本身就生成连续副本，ravel() 只返回视图，不再额外拷贝一次
+                        flat_data = np.ascontiguousarray(original_data, dtype=np.float64).ravel()
+                        del original_data # 尽早释放解码数据，降低重采样期间的内存峰值
                         
                         # 修复：将正确的通道数传递给 Rust 重采样器
                         resampled_flat = rust_audio_resampler.resample(
@@ -281,23 +624,30 @@ class AudioEngine:
                             channels # 使用局部变量 `channels`
                         )
                         
-                        self.data = resampled_flat.reshape((-1, channels)) # 使用局部变量 `channels`
+                        del flat_data
+                        self.data = resampled_flat.reshape((-1, channels)).astype(np.float32) # 使用局部变量 `channels`
                         self.samplerate = target_sr
                         logging.info("Resampling complete.")
                         
                         if cache_filepath:
                             logging.info(f"Writing resampled data to cache: {cache_filepath}")
-                            sf.write(cache_filepath, self.data, self.samplerate)
+                            # 先写临时文件再替换，避免中断时留下不完整的缓存被映射
+                            tmp_filepath = cache_filepath + '.tmp'
+                            with open(tmp_filepath, 'wb') as f:
+                                np.save(f, self.data)
+                            os.replace(tmp_filepath, cache_filepath)
                     else:
                         self.data = original_data
                         self.samplerate = original_samplerate
 
                 # --- 6. Finalize State ---
                 self.file_path = file_path
-                self.channels = channels # 使用我们之前确定的正确通道数
+                self.channels = self.data.shape[1]
                 self.position = 0
                 self.is_playing = False
                 self.is_paused = False
+                self._update_spectrum_bins()
+                self._state['duration'] = len(self.data) / self.samplerate
                 
                 # 为新加载的音轨（可能有多声道）重新初始化EQ状态
                 self._initialize_eq_zi()
@@ -309,6 +659,7 @@ class AudioEngine:
             with self.lock:
                 self.file_path = None
                 self.data = None
+                self._state['duration'] = 0
             return False
 
     def play(self):
@@ -324,6 +675,7 @@ class AudioEngine:
                 logging.info("Playback resumed.")
             elif not self.is_playing: # 从头开始播放
                 self.position = 0
+                self._seek_request = self._applied_seek_request = None
                 
                 # --- New: Configure device and exclusive mode ---
                 stream_args = {
@@ -345,6 +697,17 @@ class AudioEngine:
                         logging.error(f"Could not set WASAPI exclusive mode: {e}")
 
                 self.stream = sd.OutputStream(**stream_args)
+                # 分配预渲染缓冲区，并在启动音频流之前先填满，避免开头欠载
+                self._ring = np.zeros((4 * self._render_block, self.channels), dtype=np.float32)
+                self._render_scratch = np.empty((self._render_block, self.channels), dtype=np.float32)
+                self._ring_state = (0, 0)
+                try:
+                    self._render_ahead(0)
+                except Exception:
+                    logging.error("Failed to pre-render audio; playback not started", exc_info=True)
+                    self.stream.close()
+                    self.stream = None
+                    return False
                 self.stream.start()
                 self.is_playing = True
                 self.is_paused = False
@@ -352,8 +715,14 @@ class AudioEngine:
                 # 启动后台线程
                 if self.thread is None or not self.thread.is_alive():
                     self.stop_event.clear()
+                    self._spectrum_queue.clear()
+                    self._spectrum_ready.clear()
                     self.thread = threading.Thread(target=self._playback_thread, daemon=True)
                     self.thread.start()
+                    self.emitter_thread = threading.Thread(target=self._spectrum_emitter_thread, daemon=True)
+                    self.emitter_thread.start()
+                    self.render_thread = threading.Thread(target=self._render_thread, daemon=True)
+                    self.render_thread.start()
                 logging.info("Playback started.")
         return True
 
@@ -373,6 +742,9 @@ class AudioEngine:
                 new_position = int(position_seconds * self.samplerate)
                 if 0 <= new_position < len(self.data):
                     self.position = new_position
+                    # 回调不持有锁，通过新的请求元组通知它采用新位置，避免被回调的写回覆盖
+                    self._seek_request = (new_position,)
+                    self._render_ahead(new_position)
                     logging.info(f"Seeked to {position_seconds:.2f}s (frame {self.position})")
                     return True
         return False
@@ -387,33 +759,38 @@ class AudioEngine:
             self.is_playing = False
             self.is_paused = False
             self.position = 0
-        # 停止后台线程
+            self._seek_request = self._applied_seek_request = None
+            self._ring_state = (0, 0)
+        # 停止后台线程 (同时唤醒等待中的频谱发送线程)
         self.stop_event.set()
+        self._spectrum_ready.set()
         if self.thread and self.thread.is_alive():
             self.thread.join(timeout=1)
         self.thread = None
+        if self.emitter_thread and self.emitter_thread.is_alive():
+            self.emitter_thread.join(timeout=1)
+        self.emitter_thread = None
+        if self.render_thread and self.render_thread.is_alive():
+            self.render_thread.join(timeout=1)
+        self.render_thread = None
         logging.info("Playback stopped and resources cleaned up.")
 
     def get_state(self):
-        """获取当前播放器状态"""
-        with self.lock:
-            duration = len(self.data) / self.samplerate if self.data is not None else 0
-            current_time = self.position / self.samplerate if self.samplerate > 0 else 0
-            return {
-                'is_playing': self.is_playing,
-                'is_paused': self.is_paused,
-                'duration': duration,
-                'current_time': current_time,
-                'file_path': self.file_path,
-                'volume': self.volume,
-                'device_id': self.device_id,
-                'exclusive_mode': self.exclusive_mode
-            }
+        """获取当前播放器状态 (返回副本：调用方会把它放进广播队列)"""
+        state = self._state.copy()
+        samplerate = self.samplerate
+        state['current_time'] = self.position / samplerate if samplerate > 0 else 0
+        return state
 
     def set_volume(self, volume_level):
         """设置音量"""
+        return self.set_volume_unchecked(float(volume_level))
+
+    def set_volume_unchecked(self, volume):
+        """设置音量，调用方需保证 volume 已是 [0, 1] 范围内的 float"""
         with self.lock:
-            self.volume = float(volume_level)
+            self.volume = volume
+            self._publish_active_state()
             logging.info(f"Volume set to {self.volume}")
             return True
 
@@ -423,69 +800,64 @@ class AudioEngine:
             return
         
         nyquist = 0.5 * self.samplerate
-        self.eq_filters = {} # 总是重新创建
-        
-        bands_config = {
-           '31': (31, 1.41), '62': (62, 1.41), '125': (125, 1.41),
-           '250': (250, 1.41), '500': (500, 1.41), '1k': (1000, 1.41),
-           '2k': (2000, 1.41), '4k': (4000, 1.41), '8k': (8000, 1.41),
-           '16k': (16000, 1.41)
-        }
-
-        # 按照频率排序以保证级联处理的顺序
-        sorted_bands = sorted(bands_config.keys(), key=lambda b: bands_config[b][0])
-
-        for band in sorted_bands:
-            f0, Q = bands_config[band]
-            gain_db = self.eq_bands.get(band, 0)
-            
-            # 注意：我们为所有频段都创建滤波器，即使增益为0。
-            # 这样可以确保在回调中 `self.eq_zi[i][band]` 总是存在。
-            # 实际是否应用该滤波器由回调中的 `if self.eq_bands.get(band, 0) != 0:` 决定。
-
-            if f0 >= nyquist * 0.95:
-                logging.warning(f"EQ band {band} ({f0} Hz) is too close to Nyquist frequency ({nyquist} Hz) and will be ignored.")
-                if band in self.eq_filters:
-                    del self.eq_filters[band] #确保它不会被使用
-                continue
-
-            A = 10**(gain_db / 40.0)
-            w0 = 2 * np.pi * f0 / self.samplerate
-            alpha = np.sin(w0) / (2.0 * Q)
-
-            b0 = 1 + alpha * A
-            b1 = -2 * np.cos(w0)
-            b2 = 1 - alpha * A
-            a0 = 1 + alpha / A
-            a1 = -2 * np.cos(w0)
-            a2 = 1 - alpha / A
-            
-            b = np.array([b0, b1, b2]) / a0
-            a = np.array([a0, a1, a2]) / a0
-            
-            sos = tf2sos(b, a, analog=False)
-            self.eq_filters[band] = sos
+        f0 = _EQ_CENTER_FREQS
+        gain_db = np.array([self.eq_bands.get(band, 0) for band in _EQ_BAND_NAMES], dtype=np.float64)
+
+        # 性能优化: 所有频段都是 RBJ 峰值滤波器，用 NumPy 一次性向量化计算全部系数。
+        # 每个频段本身就是一个二阶节，无需再经过 tf2sos 分解。
+        A = 10**(gain_db / 40.0)
+        w0 = 2 * np.pi * f0 / self.samplerate
+        alpha = np.sin(w0) / (2.0 * _EQ_Q)
+        cos_w0 = np.cos(w0)
+
+        a0 = 1 + alpha / A
+        sos = np.column_stack([
+            (1 + alpha * A) / a0, # b0
+            -2 * cos_w0 / a0,     # b1
+            (1 - alpha * A) / a0, # b2
+            np.ones_like(a0),     # a0 (归一化后为1)
+            -2 * cos_w0 / a0,     # a1
+            (1 - alpha / A) / a0  # a2
+        ])
+
+        valid = f0 < nyquist * 0.95
+        for i in np.nonzero(~valid)[0]:
+            logging.warning(f"EQ band {_EQ_BAND_NAMES[i]} ({f0[i]:g} Hz) is too close to Nyquist frequency ({nyquist} Hz) and will be ignored.")
+        # 注意：我们为所有有效频段都保留滤波器，即使增益为0；实际是否级联由增益决定。
+        self.eq_filters = {_EQ_BAND_NAMES[i]: sos[i:i + 1] for i in np.nonzero(valid)[0]}
+
+        # 按频率顺序级联所有增益非零的频段，避免在音频回调中重复构建
+        active = valid & (gain_db != 0)
+        self._active_bands = [_EQ_BAND_NAMES[i] for i in np.nonzero(active)[0]]
+        self._cascaded_sos = np.ascontiguousarray(sos[active]) if self._active_bands else None
             
         self._initialize_eq_zi()
         logging.info(f"Designed EQ filters for bands: {list(self.eq_filters.keys())}")
 
-    def _initialize_eq_zi(self, channel_index=None):
-        """Initialize or reset the initial conditions for the EQ filters."""
-        if not self.eq_filters:
-            return
-
-        def init_channel(ch_idx):
-            self.eq_zi[ch_idx] = {}
-            for band, sos in self.eq_filters.items():
-                # The shape of zi for sosfilt is (n_sections, 2)
-                self.eq_zi[ch_idx][band] = np.zeros((sos.shape[0], 2))
-
-        if channel_index is not None:
-            init_channel(channel_index)
+    def _initialize_eq_zi(self):
+        """Initialize or reset the initial conditions for the cascaded EQ filter."""
+        if self._cascaded_sos is None:
+            self._cascaded_zi = None
         else:
-            self.eq_zi = {}
-            for i in range(self.channels if self.channels > 0 else 1):
-                init_channel(i)
+            # The shape of zi for sosfilt is (n_sections, 2); channels share one array as (n_sections, channels, 2)
+            self._cascaded_zi = np.zeros((self._cascaded_sos.shape[0], max(self.channels, 1), 2))
+
+        # 仅当 声道数 x 滤波节数 超过阈值时才值得承担主机与显存之间的拷贝开销
+        self._gpu_eq = None
+        if cp is not None and self._cascaded_zi is not None:
+            if self._cascaded_zi.shape[0] * self._cascaded_zi.shape[1] >= self.gpu_eq_threshold:
+                # sosfilt(axis=0) 要求 zi 为 (n_sections, 2, channels)
+                self._gpu_eq = (cp.asarray(self._cascaded_sos),
+                                cp.ascontiguousarray(cp.asarray(self._cascaded_zi).transpose(0, 2, 1)))
+        self._publish_active_state()
+        self._invalidate_lookahead()
+
+    def _publish_active_state(self):
+        """发布音频回调读取的只读快照 (级联SOS, 滤波器状态, 音量)，调用方需持有 self.lock。"""
+        sos, zi = self._gpu_eq or (self._cascaded_sos, self._cascaded_zi)
+        if not self.eq_enabled:
+            sos = None
+        self._active_state = (sos, zi, self.volume)
 
     def set_eq(self, bands, enabled):
         """Set EQ parameters and redesign filters."""
@@ -599,6 +971,53 @@ def get_audio_devices():
                 
     return {'wasapi': wasapi_devices, 'other': other_devices}
 
+# --- 状态广播合并 ---
+# 拖动音量滑块时每秒会产生几十次状态更新：在 10ms 窗口内合并，只广播最新的状态
+# 由一个常驻线程负责发送 (threading 模式下每个后台任务都是一个新的系统线程)
+_pending_state = None
+_state_cond = threading.Condition()
+_state_flusher = None
+
+def _state_flusher_loop():
+    global _pending_state
+    while True:
+        with _state_cond:
+            while _pending_state is None:
+                _state_cond.wait()
+        socketio.sleep(0.01) # 合并窗口：期间到达的更新只保留最新一份
+        with _state_cond:
+            state, _pending_state = _pending_state, None
+        socketio.emit('playback_state', state)
+
+def schedule_state_broadcast(state):
+    global _pending_state, _state_flusher
+    with _state_cond:
+        _pending_state = state
+        if _state_flusher is None:
+            _state_flusher = socketio.start_background_task(_state_flusher_loop)
+        _state_cond.notify()
+
+# --- /volume 响应缓存 ---
+# 滑块空闲时前端会重复发送相同音量：播放器未在推进且状态未变时直接复用上一次的响应体
+_last_volume_response = None # (state_key, body)
+# 成功响应的外层结构固定，只有 state 需要逐次编码
+_VOLUME_SET_PREFIX = b'{"status":"success","message":"Volume set","state":'
+# 错误响应体是常量；Response 对象仍每次新建，因为 flask-cors 会在 after_request 中修改响应头
+_ERR_INVALID_JSON = b'{"status":"error","message":"Invalid JSON"}'
+_ERR_NO_VOLUME = b'{"status":"error","message":"Volume not provided"}'
+_ERR_BAD_VOLUME = b'{"status":"error","message":"Invalid volume"}'
+_ERR_FAIL_SET = b'{"status":"error","message":"Failed to set volume"}'
+
+def _error_response(body, status):
+    return Response(body, status=status, mimetype='application/json')
+
+def _volume_state_key():
+    # 直接取 get_state 所依据的推送状态 (见 AudioEngine._state)，再加上决定 current_time 的位置与采样率
+    e = audio_engine
+    if e.is_playing and not e.is_paused: # 播放中 current_time 持续变化，不缓存
+        return None
+    return (tuple(e._state.values()), e.position, e.samplerate)
+
 # --- Flask API 路由 ---
 @app.route('/devices', methods=['GET'])
 def list_devices():
@@ -689,42 +1108,144 @@ def stop_track():
 
 @app.route('/volume', methods=['POST'])
 def set_volume():
-    data = request.get_json()
-    volume = data.get('volume')
-    if volume is None:
-        return jsonify({'status': 'error', 'message': 'Volume not provided'}), 400
-    
-    if audio_engine.set_volume(volume):
-        return jsonify({'status': 'success', 'message': 'Volume set', 'state': audio_engine.get_state()})
-    else:
-        return jsonify({'status': 'error', 'message': 'Failed to set volume'}), 500
+    # 直接用 orjson 解析请求体，不经过 get_json 的 MIME 检查与缓存
+    raw = request.get_data(cache=False)
+    try:
+        data = orjson.loads(raw) if raw else {}
+    except orjson.JSONDecodeError:
+        return _error_response(_ERR_INVALID_JSON, 400)
+    try:
+        volume = data['volume']
+    except (KeyError, TypeError):
+        return _error_response(_ERR_NO_VOLUME, 400)
+    # 在路由层完成类型与范围检查，引擎侧即可走不再校验的快速路径
+    try:
+        volume = float(volume)
+    except (TypeError, ValueError):
+        volume = -1.0
+    if not 0.0 <= volume <= 1.0:
+        return _error_response(_ERR_BAD_VOLUME, 400)
+
+    global _last_volume_response
+    cached = _last_volume_response
+    if cached is not None and volume == audio_engine.volume and cached[0] == _volume_state_key():
+        return Response(cached[1], mimetype='application/json')
+
+    # 音量未变 (例如播放中滑块重复发送) 时不再调用引擎，也无需广播
+    changed = volume != audio_engine.volume
+    if changed and not audio_engine.set_volume_unchecked(volume):
+        return _error_response(_ERR_FAIL_SET, 500)
+
+    # 先取键再取状态：两者之间若有并发的 seek/load/stop，缓存的键只会比响应体旧，下次请求直接未命中，
+    # 而不会把旧的响应体存到新状态的键下
+    key = _volume_state_key()
+    state = audio_engine.get_state()
+    if changed:
+        schedule_state_broadcast(state)
+    body = _VOLUME_SET_PREFIX + orjson.dumps(state) + b'}'
+    _last_volume_response = (key, body) if key is not None else None
+    return Response(body, mimetype='application/json')
 
 # --- SocketIO 事件处理 ---
+_CONNECT_PAYLOAD = {'data': 'Connected to Hi-Fi Audio Engine!'}
+
+# 连接/断开只做计数 (itertools.count 的 next 在 GIL 下是原子的)，由后台任务每秒汇总输出一次日志
+_connect_counter = count()
+_disconnect_counter = count()
+
+def _log_connection_stats():
+    prev_connects = prev_disconnects = 0
+    while True:
+        socketio.sleep(1)
+        # 读取计数本身也会使计数器 +1，下一轮的基准需要跳过这一次
+        connects = next(_connect_counter)
+        disconnects = next(_disconnect_counter)
+        new_connects, new_disconnects = connects - prev_connects, disconnects - prev_disconnects
+        prev_connects, prev_disconnects = connects + 1, disconnects + 1
+        if new_connects or new_disconnects:
+            logging.info(f"WebSocket clients: {new_connects} connected, {new_disconnects} disconnected")
+
 @socketio.on('connect')
 def handle_connect():
-    logging.info('Client connected to WebSocket')
-    emit('response', {'data': 'Connected to Hi-Fi Audio Engine!'})
+    next(_connect_counter)
+    emit('response', _CONNECT_PAYLOAD)
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    logging.info('Client disconnected from WebSocket')
+    next(_disconnect_counter)
+
+class _StaleWebSocketFrameFilter(logging.Filter):
+    """
+    simple-websocket 结束会话后，werkzeug 会把连接上残留的 WebSocket 帧当作下一个 HTTP 请求解析，
+    每次断开都记录一条 "code 400, message Bad request syntax/version ..." 之类的误报错误
+    (具体措辞取决于帧的字节内容)。这类请求行解析失败属于客户端错误，本服务只监听 127.0.0.1，
+    过滤掉即可；服务端异常 ("Error on request") 等其他错误照常记录。
+    """
+    def filter(self, record):
+        return 'code 400, message Bad ' not in record.getMessage()
 
 # --- 主程序入口 ---
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Hi-Fi Audio Engine for VCP')
     parser.add_argument('--resample-cache-dir', type=str, help='Directory to store resampled audio files.')
+    parser.add_argument('--socketio-msgpack', action='store_true',
+                        help='Encode Socket.IO packets with MessagePack (client must use socket.io-msgpack-parser).')
+    parser.add_argument('--websocket-only', action='store_true',
+                        help='Accept only the WebSocket transport (client must connect with transports: [\'websocket\']).')
+    parser.add_argument('--binary-spectrum', action='store_true',
+                        help='Send spectrum_data as raw uint8 bytes instead of {"data": [floats]}.')
+    parser.add_argument('--ready-fd', type=int,
+                        help='Inherited pipe fd to write one byte to once the server socket is bound '
+                             '(default: print FLASK_SERVER_READY to stdout).')
     args = parser.parse_args()
+    if args.socketio_msgpack and msgpack is None:
+        parser.error('--socketio-msgpack requires the msgpack package')
+    init_socketio(use_msgpack=args.socketio_msgpack, websocket_only=args.websocket_only)
 
+    audio_engine.binary_spectrum = args.binary_spectrum
     if args.resample_cache_dir:
         audio_engine.resample_cache_dir = args.resample_cache_dir
         logging.info(f"Resample cache directory set to: {audio_engine.resample_cache_dir}")
 
     port = 5555
-    logging.getLogger('werkzeug').disabled = True
+    # 有两个以上可用核心时：服务器线程 (及其派生线程) 固定在第一个核心，DSP 渲染与音频回调固定在第二个，
+    # 避免调度器来回迁移线程导致缓存失效。Windows/macOS 没有 sched_setaffinity，保持不绑定。
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        if len(cpus) >= 2:
+            _pin_current_thread(cpus[0])
+            audio_engine.dsp_cpu = cpus[1]
+    # 将文件描述符软上限提升到硬上限，避免并发 WebSocket 连接较多时 accept 失败 (Windows 无 resource 模块)
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        target = hard if hard != resource.RLIM_INFINITY else 65536 # macOS 的硬上限可能是无限，不能直接用作软上限
+        if soft != resource.RLIM_INFINITY and soft < target:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    except ImportError:
+        pass
+    except (ValueError, OSError) as e:
+        logging.warning(f"Could not raise open file limit: {e}")
+    # 屏蔽逐请求/逐数据包的日志，只保留真正的错误
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    logging.getLogger('werkzeug').addFilter(_StaleWebSocketFrameFilter())
+    logging.getLogger('engineio').setLevel(logging.WARNING)
+    logging.getLogger('socketio').setLevel(logging.WARNING)
     
     logging.info(f"Starting Hi-Fi Audio Engine on http://127.0.0.1:{port}")
-    # Print a ready signal to stdout so the main process knows the server is up.
-    import sys
-    print("FLASK_SERVER_READY")
-    sys.stdout.flush()
-    socketio.run(app, host='127.0.0.1', port=port, debug=False, log_output=False)
\ No newline at end of file
+    # 先完成监听端口的绑定再发出就绪信号，避免主进程在 socket 就绪前连接。
+    # 与 socketio.run 在 threading 模式下的行为一致：多线程的 werkzeug 服务器。
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    socketio.start_background_task(_log_connection_stats)
+
+    # 主进程可通过 --ready-fd 传入一个继承的管道写端，就绪时写入一个字节；
+    # 否则沿用 stdout 上的 FLASK_SERVER_READY 信号。
+    if args.ready_fd is not None:
+        os.write(args.ready_fd, b'1')
+        os.close(args.ready_fd)
+    else:
+        import sys
+        print("FLASK_SERVER_READY")
+        sys.stdout.flush()
+    server.serve_forever()
\ No newline at end of file